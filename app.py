@@ -8,6 +8,11 @@ import math
 import hashlib
 import requests
 import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import ingesta
+from indice_espacial import IndiceEspacial, cobertura_parroquias, parroquias_desatendidas, agrupar_tiendas
 
 # ==============================
 # CONFIGURACIÓN INICIAL
@@ -69,79 +74,36 @@ PROVINCIAS_COORDS = {
 # FUNCIONES AUXILIARES
 # ==============================
 
-def detectar_separador(uploaded_file):
-    """Detecta separador más probable en los primeros bytes."""
-    try:
-        head = uploaded_file.getvalue()[:8192]
-        s = head.decode('latin1', errors='ignore')
-        candidates = ['|', ';', ',', '\t']
-        counts = {sep: s.count(sep) for sep in candidates}
-        sep = max(counts, key=counts.get)
-        uploaded_file.seek(0)
-        return sep
-    except Exception:
-        try:
-            uploaded_file.seek(0)
-        except:
-            pass
-        return '|'
-
-
-def detectar_provincia(uploaded_file, df):
-    """Detecta provincia automáticamente"""
-    try:
-        nombre = uploaded_file.name.lower()
-        for prov in PROVINCIAS_COORDS:
-            if prov.lower() in nombre:
-                return prov
-    except:
-        pass
-    for col in df.columns:
-        if 'provincia' in col.lower():
-            val = df[col].dropna().mode()
-            if not val.empty:
-                return val.iloc[0]
-    return "Pichincha"
-
-
-def filtrar_por_ciiu(df):
+def _ingerir_archivos(archivos):
     """
-    Filtra por códigos CIIU de librerías y por contribuyentes activos.
+    Procesa los CSV subidos en paralelo (ver `ingesta.procesar_archivos`) mostrando
+    el avance por archivo. Los resultados se guardan en la sesión para no re-procesar
+    en cada rerun mientras no cambien los archivos.
     """
-
-    col_ciiu = None
-    for c in df.columns:
-        if 'ciiu' in c.lower():
-            col_ciiu = c
-            break
-
-    if not col_ciiu:
-        st.warning("No se encontró columna CIIU. Se mostrarán todos los registros.")
-        return df.copy()
-
-    df_temp = df.copy()
-
-    # Limpiar valores CIIU 
-    df_temp.loc[:, col_ciiu] = df_temp[col_ciiu].astype(str).str.strip()
-
-    # Filtrar por CIIU
-    mask = df_temp[col_ciiu].apply(lambda x: any(code in x for code in CIIU_CODIGOS.keys()))
-    filtrado = df_temp[mask].copy()
-
-    if filtrado.empty:
-        st.warning("No se encontraron registros con los códigos CIIU de librerías. Se mostrarán todos.")
-        return df_temp
-
-    # Filtrar solo ACTIVO si la columna existe 
-    if "ESTADO_CONTRIBUYENTE" in filtrado.columns:
-        filtrado.loc[:, "ESTADO_CONTRIBUYENTE"] = (
-            filtrado["ESTADO_CONTRIBUYENTE"].astype(str).str.upper().str.strip()
-        )
-        filtrado = filtrado[filtrado["ESTADO_CONTRIBUYENTE"] == "ACTIVO"].copy()
-    else:
-        st.warning("No se encontró la columna ESTADO_CONTRIBUYENTE. No se aplicó el filtro de activos.")
-
-    return filtrado
+    clave = tuple((a.name, a.file_id) for a in archivos)
+    previo = st.session_state.get("ingesta")
+    if previo and previo["clave"] == clave:
+        return previo["resultados"]
+
+    barra = st.progress(0.0, text=f"Procesando {len(archivos)} archivo(s)...")
+    estado = st.empty()
+    lineas = []
+
+    def _al_terminar(resultado, hechos, total):
+        icono = "❌" if resultado['error'] else "✅"
+        lineas.append(f"{icono} {resultado['archivo']}")
+        barra.progress(hechos / total, text=f"Procesados {hechos}/{total} archivos")
+        estado.markdown("  \n".join(lineas))
+
+    resultados = ingesta.procesar_archivos(
+        [(a.name, a.getvalue()) for a in archivos],
+        CIIU_CODIGOS.keys(), PROVINCIAS_COORDS.keys(),
+        al_terminar=_al_terminar,
+    )
+    barra.empty()
+    estado.empty()
+    st.session_state["ingesta"] = {"clave": clave, "resultados": resultados}
+    return resultados
 
 
 def _parse_number_try(v):
@@ -190,6 +152,15 @@ def _jitter_coords(base, key, magnitude=0.0006):
 # -------------------------
 GEOCODE_CACHE_PATH = os.path.join(os.getcwd(), "geocode_cache.json")
 
+@st.cache_resource
+def _geocode_locks():
+    """Locks compartidos entre reruns: (archivo de cache, peticiones a Nominatim)."""
+    return threading.Lock(), threading.Lock()
+
+# los trabajos en segundo plano geocodifican en paralelo: serializar escrituras
+# del cache y respetar el límite de 1 petición/seg de Nominatim
+_GEOCODE_LOCK, _NOMINATIM_LOCK = _geocode_locks()
+
 def _load_geocode_cache():
     try:
         if os.path.exists(GEOCODE_CACHE_PATH):
@@ -206,12 +177,21 @@ def _save_geocode_cache(cache):
     except:
         pass
 
+def _cache_geocode_result(key, value):
+    # recargar antes de escribir para no pisar resultados de otros hilos
+    with _GEOCODE_LOCK:
+        cache = _load_geocode_cache()
+        cache[key] = value
+        _save_geocode_cache(cache)
+
 def geocode_parroquia(parr, canton=None, provincia=None, sleep_sec=1.0):
     """Geocodifica 'parr' usando Nominatim; resultado cacheado."""
     if not parr or str(parr).strip() == "":
         return None
-    cache = _load_geocode_cache()
-    key = "|".join([str(parr).strip().lower(), str(canton or "").strip().lower(), str(provincia or "").strip().lower()])
+    # provincia sin tildes en la clave: 'Manabí' y 'MANABI' comparten entrada de cache
+    key = "|".join([str(parr).strip().lower(), str(canton or "").strip().lower(), ingesta._sin_acentos(provincia or "")])
+    with _GEOCODE_LOCK:
+        cache = _load_geocode_cache()
     if key in cache:
         v = cache[key]
         if v is None:
@@ -229,37 +209,80 @@ def geocode_parroquia(parr, canton=None, provincia=None, sleep_sec=1.0):
     url = "https://nominatim.openstreetmap.org/search"
     headers = {"User-Agent": "libros-streamlit-app/1.0 (contacto)"}
     params = {"format": "json", "q": query, "limit": 1}
+    with _NOMINATIM_LOCK:
+        try:
+            resp = requests.get(url, params=params, headers=headers, timeout=10)
+            if resp.status_code == 200:
+                data = resp.json()
+                if isinstance(data, list) and len(data) > 0:
+                    item = data[0]
+                    lat = float(item.get("lat"))
+                    lon = float(item.get("lon"))
+                    _cache_geocode_result(key, {"lat": lat, "lon": lon})
+                    time.sleep(sleep_sec)
+                    return [lat, lon]
+        except Exception:
+            pass
+
+        # cache negative result
+        _cache_geocode_result(key, None)
+        time.sleep(sleep_sec)
+    return None
+# -------------------------
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    """Distancia haversine (km) entre dos puntos."""
+    R = 6371.0
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2.0) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2.0) ** 2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+
+def _norm_text(v):
+    if pd.isna(v):
+        return None
+    s = str(v).strip()
+    if s == '':
+        return None
+    if ';' in s:
+        s = s.split(';')[-1].strip()
+    return s.lower()
+
+
+def _find_parish_match(centroides, name):
+    """Búsqueda aproximada de parroquia por nombre."""
+    if not name:
+        return None
+    key = name.lower()
+    if key in centroides:
+        return centroides[key]
+    for k in centroides.keys():
+        if key in k or k in key:
+            return centroides[k]
     try:
-        resp = requests.get(url, params=params, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            data = resp.json()
-            if isinstance(data, list) and len(data) > 0:
-                item = data[0]
-                lat = float(item.get("lat"))
-                lon = float(item.get("lon"))
-                cache[key] = {"lat": lat, "lon": lon}
-                _save_geocode_cache(cache)
-                time.sleep(sleep_sec)
-                return [lat, lon]
+        import difflib
+        matches = difflib.get_close_matches(key, list(centroides.keys()), n=1, cutoff=0.7)
+        if matches:
+            return centroides[matches[0]]
     except Exception:
         pass
-
-    # cache negative result
-    cache[key] = None
-    _save_geocode_cache(cache)
-    time.sleep(sleep_sec)
     return None
-# -------------------------
 
-def crear_mapa(df_filtrado, provincia):
+
+def _preparar_contexto_mapa(df_filtrado, provincia, avisar):
     """
-    Genera mapa centrado en la provincia dada; añade capa de parroquias (si hay GeoData)
-    y coloca marcadores REALES solo dentro de la provincia analizada.
+    Prepara todo lo necesario para ubicar marcadores SIN geocodificar:
+    columnas detectadas, centroides (GeoData + dataset), polígono de la provincia
+    y el conjunto de parroquias que faltan por geocodificar.
 
-    Cambios clave:
     - Si el CSV incluye columna de provincia, se filtra por ella primero (evita excluir por distancia).
-    - Mejora validación de coordenadas (swap si están invertidas).
     - Radius fallback aumentado para provincias grandes, pero solo usado si no hay columna provincia ni shapefile.
+
+    `avisar(nivel, texto)` recibe los mensajes para el usuario ('info', 'warning').
     """
     df = df_filtrado.reset_index(drop=True)
 
@@ -273,12 +296,14 @@ def crear_mapa(df_filtrado, provincia):
     if province_col_in_df:
         # normalizar y filtrar filas que contengan la provincia solicitada
         try:
-            mask = df[province_col_in_df].astype(str).str.lower().str.contains(str(provincia).lower(), na=False)
+            # sin tildes en ambos lados: el SRI escribe 'MANABI', la provincia canónica es 'Manabí'
+            prov_norm = ingesta._sin_acentos(provincia)
+            mask = df[province_col_in_df].astype(str).map(ingesta._sin_acentos).str.contains(prov_norm, regex=False, na=False)
             if mask.any():
                 df = df[mask].reset_index(drop=True)
-                st.info(f"Se filtraron {mask.sum()} registros por columna '{province_col_in_df}' con provincia {provincia}.")
+                avisar("info", f"Se filtraron {mask.sum()} registros por columna '{province_col_in_df}' con provincia {provincia}.")
             else:
-                st.info(f"No se encontraron filas en la columna '{province_col_in_df}' que coincidan con '{provincia}'. Se usará el dataset completo para intentar ubicar.")
+                avisar("info", f"No se encontraron filas en la columna '{province_col_in_df}' que coincidan con '{provincia}'. Se usará el dataset completo para intentar ubicar.")
         except Exception:
             pass
 
@@ -287,19 +312,6 @@ def crear_mapa(df_filtrado, provincia):
     prov_center_lat, prov_center_lon = float(centro[0]), float(centro[1])
     radius_km = 200.0  # fallback radius if no shapefile/province polygon available
 
-    # helper distancia haversine (km)
-    def _haversine_km(lat1, lon1, lat2, lon2):
-        R = 6371.0
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        dphi = math.radians(lat2 - lat1)
-        dlambda = math.radians(lon2 - lon1)
-        a = math.sin(dphi / 2.0) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2.0) ** 2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        return R * c
-
-    mapa = folium.Map(location=[prov_center_lat, prov_center_lon], zoom_start=10)
-
     # detectar columnas parroquia y canton (misma heurística)
     parroquia_col = None
     canton_col = None
@@ -319,17 +331,7 @@ def crear_mapa(df_filtrado, provincia):
                 canton_col = c
                 break
 
-    def _norm_text(v):
-        if pd.isna(v):
-            return None
-        s = str(v).strip()
-        if s == '':
-            return None
-        if ';' in s:
-            s = s.split(';')[-1].strip()
-        return s.lower()
-
-    coords_list = df.apply(obtener_coordenadas, axis=1).tolist()
+    coords_list = df.apply(obtener_coordenadas, axis=1).tolist() if not df.empty else []
 
     # intentar cargar GeoDataFrame de parroquias y FILTRAR por provincia si es posible
     gdf = None
@@ -359,10 +361,12 @@ def crear_mapa(df_filtrado, provincia):
             continue
 
     parish_centroids = {}
+    parroquias_referencia = []  # filas (nombre, lat, lon); admite parroquias homónimas
     gdf_name_field = None
     province_field = None
     province_shape = None
     use_polygon_check = False
+    parroquias_geojson = None
 
     if gdf is not None and not gdf.empty:
         # detectar campo nombre y campo provincia en el GeoDataFrame
@@ -375,24 +379,19 @@ def crear_mapa(df_filtrado, provincia):
                 province_field = candidate
                 break
 
-        # si hay campo provincia, filtrar gdf por la provincia solicitada (case-insensitive contains)
+        # si hay campo provincia, filtrar gdf por la provincia solicitada (contains sin mayúsculas ni tildes)
         if province_field:
             try:
-                mask = gdf[province_field].astype(str).str.contains(str(provincia), case=False, na=False)
-                gdf = gdf[mask]
+                mask = gdf[province_field].astype(str).map(ingesta._sin_acentos).str.contains(
+                    ingesta._sin_acentos(provincia), regex=False, na=False)
+                gdf = gdf[mask].reset_index(drop=True)
             except Exception:
                 pass
 
-        # si quedan features, agregar capa GeoJSON y construir shape para comprobación puntual
+        # si quedan features, guardar GeoJSON para la capa y construir shape para comprobación puntual
         try:
             if not gdf.empty:
-                folium.GeoJson(
-                    gdf.to_json(),
-                    name="Parroquias",
-                    tooltip=folium.GeoJsonTooltip(fields=[gdf_name_field] if gdf_name_field else None,
-                                                  aliases=["Parroquia:"] if gdf_name_field else None,
-                                                  localize=True)
-                ).add_to(mapa)
+                parroquias_geojson = gdf.to_json()
                 # crear shape para comprobaciones puntuales
                 try:
                     province_shape = gdf.unary_union
@@ -406,28 +405,30 @@ def crear_mapa(df_filtrado, provincia):
         # calcular centroides reales (solo de lo que quedó en gdf)
         try:
             centroids = gdf.geometry.centroid
-            for idx, row in gdf.iterrows():
+            # recorrer por posición: tras el filtro por provincia las etiquetas del índice no son posiciones
+            for (_, row), c in zip(gdf.iterrows(), centroids):
                 nm = None
                 if gdf_name_field and pd.notna(row.get(gdf_name_field)):
-                    nm = str(row[gdf_name_field]).strip().lower()
+                    nm = str(row[gdf_name_field]).strip()
                 else:
                     for k, v in row.items():
                         if k == gdf.geometry.name:
                             continue
                         if isinstance(v, str) and v.strip():
-                            nm = v.strip().lower()
+                            nm = v.strip()
                             break
                 if not nm:
                     continue
                 try:
-                    c = centroids.iloc[idx]
-                    parish_centroids[nm] = [float(c.y), float(c.x)]
+                    lat_c, lon_c = float(c.y), float(c.x)
                 except Exception:
                     continue
+                parish_centroids[nm.lower()] = [lat_c, lon_c]
+                parroquias_referencia.append((nm, lat_c, lon_c))
         except Exception:
             pass
     else:
-        st.info("No se encontró GeoData local de parroquias (o no cargable). Usaremos datos del dataset y geocoding como respaldo.")
+        avisar("info", "No se encontró GeoData local de parroquias (o no cargable). Usaremos datos del dataset y geocoding como respaldo.")
 
     # centroides a partir del dataset
     parr_coords = {}
@@ -458,26 +459,7 @@ def crear_mapa(df_filtrado, provincia):
     for k, v in parish_centroids.items():
         merged_parr_centroids.setdefault(k, v)
 
-    # búsqueda aproximada de parroquia por nombre
-    def _find_parish_match(name):
-        if not name:
-            return None
-        key = name.lower()
-        if key in merged_parr_centroids:
-            return merged_parr_centroids[key]
-        for k in merged_parr_centroids.keys():
-            if key in k or k in key:
-                return merged_parr_centroids[k]
-        try:
-            import difflib
-            matches = difflib.get_close_matches(key, list(merged_parr_centroids.keys()), n=1, cutoff=0.7)
-            if matches:
-                return merged_parr_centroids[matches[0]]
-        except Exception:
-            pass
-        return None
-
-    # geocodificar faltantes (solo las parroquias dentro del conjunto de filas a analizar)
+    # parroquias faltantes (solo las del conjunto de filas a analizar)
     to_geocode = set()
     if parroquia_col:
         for i, row in df.iterrows():
@@ -486,26 +468,8 @@ def crear_mapa(df_filtrado, provincia):
             p = _norm_text(row.get(parroquia_col))
             if not p:
                 continue
-            if _find_parish_match(p) is None:
+            if _find_parish_match(merged_parr_centroids, p) is None:
                 to_geocode.add(p)
-    if to_geocode:
-        st.info(f"Geocodificando {len(to_geocode)} parroquias (Nominatim, cache)...")
-        geocoded = 0
-        for p in sorted(to_geocode):
-            try:
-                g = geocode_parroquia(p, provincia=provincia, sleep_sec=0.6)
-                if g:
-                    merged_parr_centroids[p] = g
-                    geocoded += 1
-            except Exception:
-                continue
-        if geocoded:
-            st.info(f"Se geocodificaron {geocoded} parroquias (guardadas en geocode_cache.json)")
-
-    # colocar marcadores SOLO SI QUEDAN DENTRO DE LA PROVINCIA (según polygon o prov_center + radius)
-    placed_count = 0
-    missing_count = 0
-    excluded_outside = 0
 
     # if polygon check is available, import shapely Point for containment tests
     Point = None
@@ -517,150 +481,591 @@ def crear_mapa(df_filtrado, provincia):
             Point = None
             use_polygon_check = False
 
-    for i, row in df.iterrows():
-        coord = coords_list[i]
-        use_loc = None
+    return {
+        'df': df,
+        'provincia': provincia,
+        'centro': [prov_center_lat, prov_center_lon],
+        'radius_km': radius_km,
+        'parroquia_col': parroquia_col,
+        'canton_col': canton_col,
+        'coords_list': coords_list,
+        'parroquias_geojson': parroquias_geojson,
+        'gdf_name_field': gdf_name_field,
+        'province_shape': province_shape,
+        'Point': Point if use_polygon_check else None,
+        'parr_centroids': merged_parr_centroids,
+        # centroides reales (GeoData) sin mezclar con los de las tiendas: base de la cobertura
+        'parroquias_referencia': parroquias_referencia,
+        'canton_centroids': canton_from_data,
+        'to_geocode': to_geocode,
+    }
+
+
+def _ubicar_fila(ctx, row, coord):
+    """Pasos sin red: coordenadas del registro, centroide de parroquia y de cantón."""
+    use_loc = None
+
+    # 1) usar coords del registro si válidas
+    if isinstance(coord, (list, tuple)) and len(coord) >= 2:
+        try:
+            # validar y swap si necesario
+            lat_c = float(coord[0]); lon_c = float(coord[1])
+            if not (-90 <= lat_c <= 90 and -180 <= lon_c <= 180):
+                if -90 <= lon_c <= 90 and -180 <= lat_c <= 180:
+                    lat_c, lon_c = lon_c, lat_c
+            use_loc = [lat_c, lon_c]
+        except:
+            use_loc = None
+
+    # 2) centroid parroquia (real o dataset)
+    if use_loc is None and ctx['parroquia_col']:
+        pname = _norm_text(row.get(ctx['parroquia_col']))
+        use_loc = _find_parish_match(ctx['parr_centroids'], pname)
+
+    # 3) canton centroid si aún None
+    if use_loc is None and ctx['canton_col']:
+        cname = _norm_text(row.get(ctx['canton_col']))
+        if cname and cname in ctx['canton_centroids']:
+            use_loc = ctx['canton_centroids'][cname]
+
+    return use_loc
 
-        # 1) usar coords del registro si válidas
-        if isinstance(coord, (list, tuple)) and len(coord) >= 2:
+
+def _crear_marcador(ctx, i, row, use_loc):
+    """Devuelve {'location', 'popup'} o None si la ubicación cae fuera de la provincia."""
+    parroquia_col = ctx['parroquia_col']
+    canton_col = ctx['canton_col']
+
+    # verificar que la ubicación esté dentro de la provincia analizada
+    inside = False
+    try:
+        lat_val = float(use_loc[0]); lon_val = float(use_loc[1])
+        if ctx['Point'] is not None and ctx['province_shape'] is not None:
             try:
-                # validar y swap si necesario
-                lat_c = float(coord[0]); lon_c = float(coord[1])
-                if not (-90 <= lat_c <= 90 and -180 <= lon_c <= 180):
-                    if -90 <= lon_c <= 90 and -180 <= lat_c <= 180:
-                        lat_c, lon_c = lon_c, lat_c
-                use_loc = [lat_c, lon_c]
-            except:
-                use_loc = None
-
-        # 2) centroid parroquia (real o dataset)
-        if use_loc is None and parroquia_col:
-            pname = _norm_text(row.get(parroquia_col))
-            use_loc = _find_parish_match(pname)
+                pt = ctx['Point'](lon_val, lat_val)  # shapely Point(x=lon, y=lat)
+                if ctx['province_shape'].contains(pt) or ctx['province_shape'].touches(pt):
+                    inside = True
+            except Exception:
+                inside = False
+        else:
+            # fallback: distancia al centro de la provincia
+            dist_km = _haversine_km(ctx['centro'][0], ctx['centro'][1], lat_val, lon_val)
+            inside = dist_km <= ctx['radius_km']
+    except Exception:
+        inside = False
+
+    if not inside:
+        return None
+
+    # jitter para evitar solapamiento
+    try:
+        use_loc = _jitter_coords([lat_val, lon_val], key=f"{i}-{row.get(parroquia_col, '')}", magnitude=0.0005)
+    except Exception:
+        use_loc = [lat_val, lon_val]
+
+    # popup
+    nombre = None
+    for cand in ['RAZON_SOCIAL', 'razon_social', 'Nombre', 'NOMBRE', 'razon', 'nombre']:
+        if cand in row and pd.notna(row[cand]) and str(row[cand]).strip() != '':
+            nombre = str(row[cand])
+            break
+    if not nombre:
+        nombre = 'Sin nombre'
+
+    popup_lines = [f"<b>{nombre}</b>"]
+    if parroquia_col and pd.notna(row.get(parroquia_col)):
+        popup_lines.append(f"Parroquia: {row.get(parroquia_col)}")
+    if canton_col and pd.notna(row.get(canton_col)):
+        popup_lines.append(f"Cantón: {row.get(canton_col)}")
+    for col in ['DIRECCION', 'direccion', 'Direccion']:
+        if col in row and pd.notna(row[col]) and str(row[col]).strip() != '':
+            popup_lines.append(f"Dirección: {row[col]}")
+    popup = "<br>".join(popup_lines)
+
+    # 'ubicacion' conserva la posición sin jitter para el análisis de cobertura
+    return {'location': [use_loc[0], use_loc[1]], 'ubicacion': [lat_val, lon_val], 'nombre': nombre, 'popup': popup}
+
+
+def _ubicar_marcadores(ctx, avisar, agregar, progreso=None, cancelado=None):
+    """
+    Ubica cada registro y entrega los marcadores a `agregar` a medida que se resuelven:
 
-        # 3) canton centroid si aún None
-        if use_loc is None and canton_col:
-            cname = _norm_text(row.get(canton_col))
-            if cname and cname in canton_from_data:
-                use_loc = canton_from_data[cname]
+    1. Ruta rápida: registros con coordenadas o parroquia/cantón ya conocidos.
+    2. Geocodificación de parroquias faltantes (Nominatim, cache); sus registros
+       se entregan en cuanto su parroquia queda resuelta.
+    3. Respaldo para lo que sigue sin ubicar: centroide de cantón o geocoding con cantón.
 
-        # 4) intentar geocoding por parroquia si aún None
+    `cancelado()` se consulta entre geocodificaciones; lo pendiente se cuenta como no ubicado.
+    """
+    df = ctx['df']
+    parroquia_col = ctx['parroquia_col']
+    canton_col = ctx['canton_col']
+    provincia = ctx['provincia']
+    to_geocode = ctx['to_geocode']
+    progreso = progreso or (lambda fraccion, etapa: None)
+    cancelado = cancelado or (lambda: False)
+    stats = {'placed': 0, 'missing': 0, 'outside': 0}
+
+    def _colocar(i, row, use_loc):
+        if use_loc is None:
+            stats['missing'] += 1
+            return
+        marcador = _crear_marcador(ctx, i, row, use_loc)
+        if marcador is None:
+            stats['outside'] += 1
+            return
+        agregar(marcador)
+        stats['placed'] += 1
+
+    # 1) ruta rápida; las filas de parroquias por geocodificar esperan (la parroquia geocodificada
+    #    tiene prioridad sobre el centroide de cantón)
+    pendientes = {}
+    for i, row in df.iterrows():
+        coord = ctx['coords_list'][i]
+        pname = _norm_text(row.get(parroquia_col)) if parroquia_col else None
+        if coord is None and pname in to_geocode:
+            pendientes.setdefault(pname, []).append(i)
+            continue
+        use_loc = _ubicar_fila(ctx, row, coord)
+        if use_loc is None and pname:
+            pendientes.setdefault(pname, []).append(i)
+            continue
+        _colocar(i, row, use_loc)
+    progreso(0.0, f"{stats['placed']} registros ubicados sin geocodificar")
+
+    # 2) geocodificar parroquias faltantes
+    if to_geocode:
+        avisar("info", f"Geocodificando {len(to_geocode)} parroquias (Nominatim, cache)...")
+        geocoded = 0
+        total = len(to_geocode)
+        for n, p in enumerate(sorted(to_geocode), start=1):
+            if cancelado():
+                break
+            g = None
+            try:
+                g = geocode_parroquia(p, provincia=provincia, sleep_sec=0.6)
+            except Exception:
+                g = None
+            if g:
+                ctx['parr_centroids'][p] = g
+                geocoded += 1
+                for i in pendientes.pop(p, []):
+                    _colocar(i, df.iloc[i], g)
+            progreso(n / total, f"Geocodificando parroquias ({n}/{total})")
+        if geocoded:
+            avisar("info", f"Se geocodificaron {geocoded} parroquias (guardadas en geocode_cache.json)")
+
+    # 3) respaldo: parroquia aproximada, cantón y geocoding con cantón
+    respaldo = [i for filas in pendientes.values() for i in filas]
+    for n, i in enumerate(sorted(respaldo), start=1):
+        if cancelado():
+            stats['missing'] += len(respaldo) - n + 1
+            break
+        row = df.iloc[i]
+        use_loc = _ubicar_fila(ctx, row, ctx['coords_list'][i])
         if use_loc is None and parroquia_col:
             pname = _norm_text(row.get(parroquia_col))
             if pname:
                 geoc = geocode_parroquia(pname, canton=_norm_text(row.get(canton_col)) if canton_col else None, provincia=provincia, sleep_sec=0.6)
                 if geoc:
-                    merged_parr_centroids[pname] = geoc
+                    ctx['parr_centroids'][pname] = geoc
                     use_loc = geoc
+        _colocar(i, row, use_loc)
+        progreso(1.0, f"Ubicando registros restantes ({n}/{len(respaldo)})")
 
-        if use_loc is None:
-            missing_count += 1
-            continue
+    return stats
 
-        # verificar que la ubicación esté dentro de la provincia analizada
-        inside = False
-        try:
-            lat_val = float(use_loc[0]); lon_val = float(use_loc[1])
-            if use_polygon_check and Point is not None and province_shape is not None:
-                try:
-                    pt = Point(lon_val, lat_val)  # shapely Point(x=lon, y=lat)
-                    if province_shape.contains(pt) or province_shape.touches(pt):
-                        inside = True
-                except Exception:
-                    inside = False
-            else:
-                # fallback: distancia al centro de la provincia
-                dist_km = _haversine_km(prov_center_lat, prov_center_lon, lat_val, lon_val)
-                inside = dist_km <= radius_km
-        except Exception:
-            inside = False
 
-        if not inside:
-            excluded_outside += 1
-            continue
+def _construir_mapa(ctx, marcadores, cobertura=None):
+    """
+    Mapa folium con la capa de parroquias (si hay GeoData) y los marcadores dados.
+    `cobertura` (ver `_analizar_cobertura`) agrega capas de distancia por parroquia y grupos de tiendas.
+    """
+    mapa = folium.Map(location=ctx['centro'], zoom_start=10)
 
-        # jitter para evitar solapamiento
+    if ctx['parroquias_geojson'] is not None:
+        gdf_name_field = ctx['gdf_name_field']
         try:
-            use_loc = _jitter_coords([lat_val, lon_val], key=f"{i}-{row.get(parroquia_col, '')}", magnitude=0.0005)
+            folium.GeoJson(
+                ctx['parroquias_geojson'],
+                name="Parroquias",
+                tooltip=folium.GeoJsonTooltip(fields=[gdf_name_field] if gdf_name_field else None,
+                                              aliases=["Parroquia:"] if gdf_name_field else None,
+                                              localize=True)
+            ).add_to(mapa)
         except Exception:
-            use_loc = [lat_val, lon_val]
+            pass
 
-        # popup
-        nombre = None
-        for cand in ['RAZON_SOCIAL', 'razon_social', 'Nombre', 'NOMBRE', 'razon', 'nombre']:
-            if cand in row and pd.notna(row[cand]) and str(row[cand]).strip() != '':
-                nombre = str(row[cand])
-                break
-        if not nombre:
-            nombre = 'Sin nombre'
-
-        popup_lines = [f"<b>{nombre}</b>"]
-        if parroquia_col and pd.notna(row.get(parroquia_col)):
-            popup_lines.append(f"Parroquia: {row.get(parroquia_col)}")
-        if canton_col and pd.notna(row.get(canton_col)):
-            popup_lines.append(f"Cantón: {row.get(canton_col)}")
-        for col in ['DIRECCION', 'direccion', 'Direccion']:
-            if col in row and pd.notna(row[col]) and str(row[col]).strip() != '':
-                popup_lines.append(f"Dirección: {row[col]}")
-        popup = "<br>".join(popup_lines)
-
-        folium.Marker(location=[use_loc[0], use_loc[1]], popup=popup, icon=folium.Icon(color="blue")).add_to(mapa)
-        placed_count += 1
+    for m in marcadores:
+        folium.Marker(location=m['location'], popup=m['popup'], icon=folium.Icon(color="blue")).add_to(mapa)
+
+    if cobertura is not None and cobertura['parroquias'] is not None:
+        capa_parr = folium.FeatureGroup(name="Cobertura por parroquia")
+        for _, r in cobertura['parroquias'].iterrows():
+            desatendida = r['distancia_km'] > cobertura['umbral_km']
+            folium.CircleMarker(
+                location=[r['lat'], r['lon']], radius=6, weight=1, fill=True, fill_opacity=0.7,
+                color="red" if desatendida else "green",
+                popup=f"<b>{r['parroquia']}</b><br>Librería más cercana: {r['distancia_km']:.1f} km"
+            ).add_to(capa_parr)
+        capa_parr.add_to(mapa)
+
+    if cobertura is not None:
+        capa_grupos = folium.FeatureGroup(name="Grupos de librerías", show=False)
+        for _, g in cobertura['grupos'][cobertura['grupos']['tiendas'] > 1].iterrows():
+            folium.Circle(
+                location=[g['lat'], g['lon']], radius=cobertura['radio_km'] * 1000, color="purple",
+                fill=True, fill_opacity=0.15,
+                popup=f"Grupo {g['grupo']}: {g['tiendas']} librerías a menos de {cobertura['radio_km']} km entre sí"
+            ).add_to(capa_grupos)
+        capa_grupos.add_to(mapa)
 
     try:
         folium.LayerControl().add_to(mapa)
     except Exception:
         pass
+    return mapa
+
+
+def _finalizar_mapa(ctx, marcadores, stats, avisar):
+    """Guarda el mapa final en HTML y reporta el resumen de ubicación."""
+    mapa = _construir_mapa(ctx, marcadores)
+    provincia = ctx['provincia']
 
     try:
         out_path = os.path.join(os.getcwd(), "map_parroquias.html")
         mapa.save(out_path)
-        st.info(f"Mapa guardado en: {out_path}")
+        avisar("info", f"Mapa guardado en: {out_path}")
     except Exception:
         pass
 
-    if excluded_outside > 0:
-        st.warning(f"Se excluyeron {excluded_outside} ubicaciones fuera de {provincia} (según polígono o radio {int(radius_km)} km).")
-    if missing_count > 0:
-        st.warning(f"⚠️ {missing_count} registros no pudieron ubicarse.")
-    st.info(f"Marcadores colocados dentro de {provincia}: {placed_count} / {len(df)}")
-
+    if stats['outside'] > 0:
+        avisar("warning", f"Se excluyeron {stats['outside']} ubicaciones fuera de {provincia} (según polígono o radio {int(ctx['radius_km'])} km).")
+    if stats['missing'] > 0:
+        avisar("warning", f"⚠️ {stats['missing']} registros no pudieron ubicarse.")
+    avisar("info", f"Marcadores colocados dentro de {provincia}: {stats['placed']} / {len(ctx['df'])}")
     return mapa
 
 
+def _analizar_cobertura(ctx, marcadores, umbral_km=5.0, radio_km=2.0):
+    """
+    Cobertura sobre las librerías ubicadas (índice espacial):
+    distancia de cada parroquia a la librería más cercana, parroquias desatendidas
+    (más de `umbral_km`) y grupos de librerías a menos de `radio_km` entre sí.
+
+    Las parroquias salen solo de la GeoData (`parroquias_referencia`): los centroides
+    del dataset o geocodificados provienen de las propias tiendas y siempre darían ~0 km.
+    Sin GeoData, 'parroquias' y 'desatendidas' son None.
+    """
+    ubicaciones = [m['ubicacion'] for m in marcadores]
+    indice = IndiceEspacial(ubicaciones)
+    parroquias = desatendidas = None
+    if ctx['parroquias_referencia']:
+        parroquias = cobertura_parroquias(ctx['parroquias_referencia'], indice)
+        parroquias['libreria_mas_cercana'] = [
+            marcadores[t]['nombre'] if t >= 0 else None for t in parroquias['tienda']
+        ]
+        desatendidas = parroquias_desatendidas(parroquias, umbral_km)
+
+    etiquetas = agrupar_tiendas(indice, radio_km)
+    tiendas = pd.DataFrame({
+        'grupo': etiquetas,
+        'nombre': [m['nombre'] for m in marcadores],
+        'lat': [u[0] for u in ubicaciones],
+        'lon': [u[1] for u in ubicaciones],
+    })
+    grupos = (tiendas.groupby('grupo')
+              .agg(tiendas=('nombre', 'size'), lat=('lat', 'mean'), lon=('lon', 'mean'),
+                   librerias=('nombre', lambda s: ", ".join(s)))
+              .reset_index()
+              .sort_values('tiendas', ascending=False))
+
+    return {
+        'parroquias': parroquias,
+        'desatendidas': desatendidas,
+        'grupos': grupos,
+        'umbral_km': umbral_km,
+        'radio_km': radio_km,
+    }
+
+
+def _avisar_streamlit(nivel, texto):
+    getattr(st, nivel)(texto)
+
+
+# ==============================
+# TRABAJOS EN SEGUNDO PLANO
+# ==============================
+
+# sin consultas de la interfaz durante este tiempo, la sesión se da por cerrada.
+# Debe ser de minutos: los navegadores frenan los temporizadores de pestañas en segundo
+# plano (Chrome: ~1 por minuto), y el sondeo del fragmento depende de ellos.
+TRABAJO_SIN_SONDEO_SEG = 10 * 60
+
+
+class TrabajoMapa:
+    """Estado de un trabajo de mapa compartido entre el hilo de trabajo y la interfaz."""
+
+    def __init__(self, provincia):
+        self.id = uuid.uuid4().hex[:12]
+        self.provincia = provincia
+        self.estado = "pendiente"  # pendiente | ejecutando | terminado | cancelado | error
+        self.progreso = 0.0
+        self.etapa = "En cola"
+        self.contexto = None
+        self.error = None
+        self._marcadores = []
+        self._mensajes = []
+        self._lock = threading.Lock()
+        self._cancelar = threading.Event()
+        self.ultimo_sondeo = time.monotonic()
+
+    @property
+    def terminado(self):
+        return self.estado in ("terminado", "cancelado", "error")
+
+    def cancelar(self):
+        self._cancelar.set()
+
+    def tocar(self):
+        """La interfaz sigue mostrando el trabajo (llamado en cada sondeo)."""
+        self.ultimo_sondeo = time.monotonic()
+
+    @property
+    def abandonado(self):
+        return time.monotonic() - self.ultimo_sondeo > TRABAJO_SIN_SONDEO_SEG
+
+    def cancelado(self):
+        # si la sesión se cerró (nadie consulta), dejar de geocodificar y liberar el pool
+        if not self._cancelar.is_set() and self.abandonado:
+            self._cancelar.set()
+        return self._cancelar.is_set()
+
+    def agregar(self, marcador):
+        with self._lock:
+            self._marcadores.append(marcador)
+
+    def avisar(self, nivel, texto):
+        with self._lock:
+            self._mensajes.append((nivel, texto))
+
+    def reportar(self, fraccion, etapa):
+        self.progreso = min(max(float(fraccion), 0.0), 1.0)
+        self.etapa = etapa
+
+    def instantanea(self):
+        """Copia de (marcadores, mensajes) hasta el momento."""
+        with self._lock:
+            return list(self._marcadores), list(self._mensajes)
+
+
+def _ejecutar_trabajo_mapa(trabajo, df_filtrado):
+    if trabajo.cancelado():
+        # cancelado o abandonado mientras esperaba en cola
+        trabajo.estado = "cancelado"
+        return
+    trabajo.estado = "ejecutando"
+    try:
+        trabajo.reportar(0.0, "Preparando centroides y coordenadas")
+        ctx = _preparar_contexto_mapa(df_filtrado, trabajo.provincia, trabajo.avisar)
+        trabajo.contexto = ctx
+        stats = _ubicar_marcadores(ctx, trabajo.avisar, trabajo.agregar, trabajo.reportar, trabajo.cancelado)
+        marcadores, _ = trabajo.instantanea()
+        _finalizar_mapa(ctx, marcadores, stats, trabajo.avisar)
+        trabajo.reportar(1.0, "Listo")
+        trabajo.estado = "cancelado" if trabajo.cancelado() else "terminado"
+    except Exception as e:
+        trabajo.error = e
+        trabajo.estado = "error"
+
+
+@st.cache_resource
+def _pool_trabajos():
+    """
+    Pool de hilos y registro de trabajos en curso; sobreviven a los reruns de Streamlit.
+    Los trabajos terminados pasan a la sesión (ver `_trabajo_de_sesion`).
+    """
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="mapa"), {}
+
+
+def _purgar_trabajos():
+    """Quita del registro los trabajos terminados que ninguna sesión vino a buscar."""
+    registro = _pool_trabajos()[1]
+    for job_id, trabajo in list(registro.items()):
+        if trabajo.terminado and trabajo.abandonado:
+            registro.pop(job_id, None)
+
+
+def lanzar_trabajo_mapa(df_filtrado, provincia):
+    """Encola la construcción del mapa y devuelve el ID del trabajo."""
+    _purgar_trabajos()
+    pool, registro = _pool_trabajos()
+    trabajo = TrabajoMapa(provincia)
+    registro[trabajo.id] = trabajo
+    pool.submit(_ejecutar_trabajo_mapa, trabajo, df_filtrado.copy())
+    return trabajo.id
+
+
+def obtener_trabajo(job_id):
+    return _pool_trabajos()[1].get(job_id)
+
+
+def cancelar_trabajo(job_id, descartar=False):
+    """Pide cancelar el trabajo; con `descartar` además lo quita del registro."""
+    registro = _pool_trabajos()[1]
+    trabajo = registro.pop(job_id, None) if descartar else registro.get(job_id)
+    if trabajo is not None:
+        trabajo.cancelar()
+
+
+def _trabajo_de_sesion(df_filtrado, provincia):
+    """
+    Reutiliza el trabajo de la sesión si los datos no cambiaron; si no, lanza uno nuevo.
+    Un trabajo terminado se saca del registro global y queda solo en la sesión,
+    que Streamlit libera al cerrarse.
+    """
+    clave = hashlib.md5(pd.util.hash_pandas_object(df_filtrado, index=False).values.tobytes()).hexdigest() + f"|{provincia}"
+    actual = st.session_state.get("trabajo_mapa")
+    if actual and actual["clave"] == clave:
+        if actual.get("trabajo") is not None:
+            return actual["trabajo"]
+        trabajo = obtener_trabajo(actual["id"])
+        if trabajo is not None:
+            trabajo.tocar()
+            if trabajo.terminado:
+                _pool_trabajos()[1].pop(trabajo.id, None)
+                actual["trabajo"] = trabajo
+            return trabajo
+    if actual:
+        cancelar_trabajo(actual["id"], descartar=True)
+    job_id = lanzar_trabajo_mapa(df_filtrado, provincia)
+    st.session_state["trabajo_mapa"] = {"clave": clave, "id": job_id}
+    return obtener_trabajo(job_id)
+
+
+def _mostrar_mensajes(mensajes):
+    for nivel, texto in mensajes:
+        _avisar_streamlit(nivel, texto)
+
+
+@st.fragment(run_every=2)
+def _seguir_trabajo_mapa(job_id):
+    """Refresca el progreso y los marcadores ya ubicados sin re-ejecutar todo el script."""
+    trabajo = obtener_trabajo(job_id)
+    if trabajo is None:
+        return
+    trabajo.tocar()
+    if trabajo.terminado:
+        st.rerun()
+
+    st.progress(trabajo.progreso, text=f"Trabajo {trabajo.id}: {trabajo.etapa}")
+    if st.button("⏹️ Cancelar", key=f"cancelar-{trabajo.id}"):
+        trabajo.cancelar()
+
+    marcadores, mensajes = trabajo.instantanea()
+    _mostrar_mensajes(mensajes)
+    if trabajo.contexto is not None:
+        st.caption(f"{len(marcadores)} marcadores ubicados hasta ahora...")
+        st_folium(_construir_mapa(trabajo.contexto, marcadores), width=1400, height=600,
+                  key=f"mapa-{trabajo.id}", returned_objects=[])
+
+
+def _mostrar_resultado_mapa(trabajo):
+    marcadores, mensajes = trabajo.instantanea()
+    _mostrar_mensajes(mensajes)
+    if trabajo.estado == "error":
+        st.error(f"Error al generar el mapa: {trabajo.error}")
+        return
+    if trabajo.estado == "cancelado":
+        st.warning("Trabajo cancelado: el mapa muestra solo los registros ubicados hasta ese momento.")
+
+    # COBERTURA Y BRECHAS
+    st.markdown("#### 📐 Cobertura y brechas")
+    col1, col2 = st.columns(2)
+    with col1:
+        umbral_km = st.slider("Parroquia desatendida si la librería más cercana está a más de (km)",
+                              min_value=1.0, max_value=50.0, value=5.0, step=0.5)
+    with col2:
+        radio_km = st.slider("Agrupar librerías a menos de (km) entre sí",
+                             min_value=0.5, max_value=10.0, value=2.0, step=0.5)
+    cobertura = _analizar_cobertura(trabajo.contexto, marcadores, umbral_km, radio_km)
+
+    hay_cobertura = cobertura['parroquias'] is not None
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        analizadas = len(cobertura['parroquias']) if hay_cobertura else "No disponible"
+        st.markdown(f"<div class='metric-card'><h3>Parroquias analizadas</h3><h2>{analizadas}</h2></div>", unsafe_allow_html=True)
+    with col2:
+        desatendidas = len(cobertura['desatendidas']) if hay_cobertura else "No disponible"
+        st.markdown(f"<div class='metric-card'><h3>Parroquias desatendidas</h3><h2>{desatendidas}</h2></div>", unsafe_allow_html=True)
+    with col3:
+        agrupadas = int(cobertura['grupos'].loc[cobertura['grupos']['tiendas'] > 1, 'tiendas'].sum())
+        st.markdown(f"<div class='metric-card'><h3>Librerías agrupadas</h3><h2>{agrupadas} / {len(marcadores)}</h2></div>", unsafe_allow_html=True)
+
+    st_folium(_construir_mapa(trabajo.contexto, marcadores, cobertura), width=1400, height=600,
+              key=f"mapa-{trabajo.id}", returned_objects=[])
+
+    if hay_cobertura:
+        with st.expander(f"Parroquias desatendidas (> {umbral_km} km)"):
+            st.dataframe(cobertura['desatendidas'].drop(columns=['tienda']), width='stretch')
+        with st.expander("Distancia de cada parroquia a la librería más cercana"):
+            st.dataframe(cobertura['parroquias'].drop(columns=['tienda']), width='stretch')
+    else:
+        st.info("Cobertura por parroquia no disponible: se necesita un parroquias.geojson (o .shp) "
+                "con los centroides reales de las parroquias.")
+    with st.expander(f"Grupos de librerías (a menos de {radio_km} km entre sí)"):
+        st.dataframe(cobertura['grupos'][cobertura['grupos']['tiendas'] > 1], width='stretch')
+
+
 # ==============================
 # INTERFAZ PRINCIPAL
 # ==============================
 st.title("📚 Análisis de Venta de Libros por Provincia")
 st.caption("Sistema para analizar distribución de librerías en Ecuador")
 
-archivo = st.file_uploader("📤 Carga tu dataset CSV", type=["csv"])
+archivos = st.file_uploader("📤 Carga tus datasets CSV (uno o varios, p. ej. uno por provincia)",
+                            type=["csv"], accept_multiple_files=True)
 
-if archivo:
+if archivos:
     try:
-        # Detectar separador y leer CSV
-        sep = detectar_separador(archivo)
-        archivo.seek(0)
-        df = pd.read_csv(archivo, sep=sep, encoding='latin1', engine='python', on_bad_lines='skip', dtype=str)
-
-        # Si quedó todo en una columna y hay muchos ';' en el contenido, reintentar con ';'
-        if df.shape[1] == 1:
-            col0 = df.columns[0]
-            sample = df[col0].dropna().head(5).astype(str)
-            if sample.str.contains(';').sum() >= 1:
-                archivo.seek(0)
-                df_try = pd.read_csv(archivo, sep=';', encoding='latin1', engine='python', on_bad_lines='skip', dtype=str)
-                if df_try.shape[1] > 1:
-                    df = df_try
-                    sep = ';'
-
-        st.success(f"✅ Dataset cargado con {len(df)} registros. (sep='{sep}')")
-        st.dataframe(df.head())
-
-        provincia = detectar_provincia(archivo, df)
-        st.info(f"📍 Provincia detectada automáticamente: **{provincia}**")
-
-        df_filtrado = filtrar_por_ciiu(df)
+        # Leer, detectar separador/provincia y filtrar por CIIU cada archivo en paralelo
+        resultados = _ingerir_archivos(archivos)
+        validos = [r for r in resultados if r['error'] is None]
+
+        for r in resultados:
+            if r['error']:
+                st.error(f"❌ {r['archivo']}: no se pudo procesar ({r['error']})")
+            for aviso in r['avisos']:
+                st.warning(f"{r['archivo']}: {aviso}")
+
+        if not validos:
+            raise ValueError("ningún archivo pudo procesarse.")
+
+        resumen = pd.DataFrame([{
+            'Archivo': r['archivo'],
+            'Provincia detectada': r['provincia'],
+            'Separador': r['sep'],
+            'Registros': r['registros'],
+            'Librerías': len(r['filtrado']),
+        } for r in validos])
+        st.success(f"✅ {len(validos)} de {len(resultados)} archivo(s) cargados con {resumen['Registros'].sum()} registros.")
+        st.dataframe(resumen, width='stretch', hide_index=True)
+
+        df_filtrado = ingesta.combinar_resultados(validos)
+        total_registros = int(resumen['Registros'].sum())
+
+        provincias = list(dict.fromkeys(r['provincia'] for r in validos))
+        if len(provincias) > 1:
+            st.subheader("🧭 Comparación por provincia")
+            st.dataframe(
+                resumen.groupby('Provincia detectada')
+                       .agg(Archivos=('Archivo', 'size'), Registros=('Registros', 'sum'), Librerías=('Librerías', 'sum'))
+                       .sort_values('Librerías', ascending=False),
+                width='stretch')
+            provincia = st.selectbox("📍 Provincia a mapear", provincias)
+        else:
+            provincia = provincias[0]
+            st.info(f"📍 Provincia detectada automáticamente: **{provincia}**")
 
 # 1. DATOS FILTRADOS (VISTA PREVIA)
         st.subheader("📦 Datos filtrados (vista previa)")
@@ -670,7 +1075,7 @@ if archivo:
         # MÉTRICAS
         col1, col2, col3 = st.columns(3)
         with col1:
-            st.markdown(f"<div class='metric-card'><h3>Total registros</h3><h2>{len(df)}</h2></div>", unsafe_allow_html=True)
+            st.markdown(f"<div class='metric-card'><h3>Total registros</h3><h2>{total_registros}</h2></div>", unsafe_allow_html=True)
         with col2:
             st.markdown(f"<div class='metric-card'><h3>Librerías</h3><h2>{len(df_filtrado)}</h2></div>", unsafe_allow_html=True)
         with col3:
@@ -705,12 +1110,22 @@ if archivo:
             else:
                 st.markdown(f"<div class='metric-card'><h3>Parroquia con más tiendas</h3><h2>No existe columna de parroquia</h2></div>", unsafe_allow_html=True)
 
-        # MAPA
-        mapa = crear_mapa(df_filtrado, provincia)
+        # MAPA (en segundo plano: los registros con coordenadas aparecen de inmediato)
         st.subheader(f"🗺️ Mapa de librerías en {provincia}")
-        st_folium(mapa, width=1400, height=600)
+        df_provincia = df_filtrado
+        if len(provincias) > 1:
+            # quitar columnas que solo existen en archivos de otras provincias (vacías aquí)
+            df_provincia = df_filtrado[df_filtrado['PROVINCIA_DETECTADA'] == provincia].dropna(axis=1, how='all')
+        trabajo = _trabajo_de_sesion(df_provincia, provincia)
+        if trabajo.terminado:
+            _mostrar_resultado_mapa(trabajo)
+            if trabajo.estado == "cancelado" and st.button("🔄 Reanudar ubicación"):
+                st.session_state.pop("trabajo_mapa", None)
+                st.rerun()
+        else:
+            _seguir_trabajo_mapa(trabajo.id)
 
     except Exception as e:
-        st.error(f"Error al procesar el archivo: {e}")
+        st.error(f"Error al procesar los archivos: {e}")
 else:
-    st.info("👆 Sube un archivo CSV para comenzar el análisis.")
\ No newline at end of file
+    st.info("👆 Sube uno o varios archivos CSV para comenzar el análisis.")
\ No newline at end of file
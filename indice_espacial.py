@@ -0,0 +1,220 @@
+import numpy as np
+import pandas as pd
+
+# ==============================
+# ÍNDICE ESPACIAL (grilla sobre la esfera unitaria)
+# ==============================
+
+RADIO_TIERRA_KM = 6371.0
+
+
+def a_unitarias(lat, lon):
+    """Convierte lat/lon (grados) a vectores unitarios 3D, forma (n, 3)."""
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def _km_a_cuerda(km):
+    return 2.0 * np.sin(np.asarray(km, dtype=float) / (2.0 * RADIO_TIERRA_KM))
+
+
+def _cuerda_a_km(cuerda):
+    return 2.0 * RADIO_TIERRA_KM * np.arcsin(np.clip(np.asarray(cuerda, dtype=float) / 2.0, 0.0, 1.0))
+
+
+def haversine_km_vec(lat1, lon1, lat2, lon2):
+    """Versión vectorizada (numpy, con broadcasting) de la distancia haversine en km."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(np.asarray(lon2, dtype=float) - np.asarray(lon1, dtype=float))
+    a = np.sin(dphi / 2.0) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2.0) ** 2
+    return 2.0 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _como_latlon(coords):
+    arr = np.asarray(coords, dtype=float)
+    if arr.size == 0:
+        return np.empty((0, 2))
+    return arr.reshape(-1, 2)
+
+
+class IndiceEspacial:
+    """
+    Índice de vecinos sobre puntos [lat, lon].
+
+    Los puntos se llevan a la esfera unitaria y se agrupan en celdas cúbicas de
+    `celda_km` de lado; las consultas solo comparan contra las celdas vecinas,
+    por grupos de consultas que comparten celda (distancias calculadas con numpy).
+    """
+
+    def __init__(self, coords, celda_km=5.0):
+        self.coords = _como_latlon(coords)
+        self.puntos = a_unitarias(self.coords[:, 0], self.coords[:, 1])
+        self.celda = float(_km_a_cuerda(celda_km))
+        # base para codificar (ix, iy, iz) en un solo entero
+        self._base = int(np.ceil(2.0 / self.celda)) + 3
+        self._desplazamiento = self._base // 2
+
+        celdas = self._celdas(self.puntos)
+        claves = self._codificar(celdas)
+        self._orden = np.argsort(claves, kind="stable")
+        self._claves, self._inicios, self._conteos = np.unique(
+            claves[self._orden], return_index=True, return_counts=True)
+
+    def __len__(self):
+        return len(self.puntos)
+
+    def _celdas(self, puntos):
+        return np.floor(puntos / self.celda).astype(np.int64)
+
+    def _codificar(self, celdas):
+        c = celdas + self._desplazamiento
+        return (c[:, 0] * self._base + c[:, 1]) * self._base + c[:, 2]
+
+    def _candidatos(self, celda, s):
+        """Índices de los puntos en el cubo de celdas de radio `s` alrededor de `celda`."""
+        if (2 * s + 1) ** 3 >= len(self._claves):
+            return np.arange(len(self.puntos))
+        r = np.arange(-s, s + 1)
+        offsets = np.stack(np.meshgrid(r, r, r, indexing="ij"), axis=-1).reshape(-1, 3)
+        claves = self._codificar(celda[None, :] + offsets)
+        pos = np.minimum(np.searchsorted(self._claves, claves), len(self._claves) - 1)
+        pos = pos[self._claves[pos] == claves]
+        if len(pos) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self._orden[self._inicios[p]:self._inicios[p] + self._conteos[p]] for p in pos])
+
+    def _grupos(self, consultas):
+        """Agrupa las consultas por celda: (celda, índices de consulta)."""
+        celdas = self._celdas(consultas)
+        claves = self._codificar(celdas)
+        _, inversa = np.unique(claves, return_inverse=True)
+        inversa = inversa.ravel()
+        for g in range(inversa.max() + 1 if len(inversa) else 0):
+            idx = np.nonzero(inversa == g)[0]
+            yield celdas[idx[0]], idx
+
+    def k_vecinos(self, coords, k=1):
+        """
+        Los `k` puntos más cercanos a cada consulta [lat, lon].
+
+        Devuelve (distancias_km, indices), ambos de forma (m, k), ordenados por distancia.
+        """
+        q = _como_latlon(coords)
+        m = len(q)
+        k = min(int(k), len(self.puntos))
+        dist = np.full((m, k), np.inf)
+        idx = np.full((m, k), -1, dtype=np.int64)
+        if m == 0 or k <= 0:
+            return dist, idx
+
+        consultas = a_unitarias(q[:, 0], q[:, 1])
+        for celda, grupo in self._grupos(consultas):
+            s = 1
+            while len(grupo):
+                cand = self._candidatos(celda, s)
+                completo = len(cand) == len(self.puntos)
+                if len(cand) >= k:
+                    d = np.linalg.norm(consultas[grupo][:, None, :] - self.puntos[cand][None, :, :], axis=2)
+                    sel = np.argpartition(d, k - 1, axis=1)[:, :k] if k < len(cand) else np.tile(np.arange(len(cand)), (len(grupo), 1))
+                    d_sel = np.take_along_axis(d, sel, axis=1)
+                    orden = np.argsort(d_sel, axis=1)
+                    d_sel = np.take_along_axis(d_sel, orden, axis=1)
+                    sel = np.take_along_axis(sel, orden, axis=1)
+                    # todo punto a cuerda <= s*celda está dentro del cubo de radio s
+                    ok = np.ones(len(grupo), dtype=bool) if completo else d_sel[:, -1] <= s * self.celda
+                    dist[grupo[ok]] = _cuerda_a_km(d_sel[ok])
+                    idx[grupo[ok]] = cand[sel[ok]]
+                    grupo = grupo[~ok]
+                s *= 2
+        return dist, idx
+
+    def en_radio(self, coords, radio_km):
+        """Para cada consulta [lat, lon], índices de los puntos a <= `radio_km` (ordenados por distancia)."""
+        q = _como_latlon(coords)
+        resultado = [np.empty(0, dtype=np.int64) for _ in range(len(q))]
+        if len(q) == 0 or len(self.puntos) == 0:
+            return resultado
+
+        consultas = a_unitarias(q[:, 0], q[:, 1])
+        radio = float(_km_a_cuerda(radio_km))
+        s = max(1, int(np.ceil(radio / self.celda)))
+        for celda, grupo in self._grupos(consultas):
+            cand = self._candidatos(celda, s)
+            if len(cand) == 0:
+                continue
+            d = np.linalg.norm(consultas[grupo][:, None, :] - self.puntos[cand][None, :, :], axis=2)
+            for fila, qi in enumerate(grupo):
+                dentro = np.nonzero(d[fila] <= radio)[0]
+                resultado[qi] = cand[dentro[np.argsort(d[fila, dentro])]]
+        return resultado
+
+    def pares_en_radio(self, radio_km):
+        """Pares (i, j), i < j, de puntos del índice a <= `radio_km` entre sí; forma (p, 2)."""
+        vecinos = self.en_radio(self.coords, radio_km)
+        pares = [(i, j) for i, vs in enumerate(vecinos) for j in vs if i < j]
+        return np.array(pares, dtype=np.int64).reshape(-1, 2)
+
+
+# ==============================
+# CAPAS DE COBERTURA
+# ==============================
+
+def cobertura_parroquias(parroquias, indice):
+    """
+    Distancia desde el centroide de cada parroquia (filas (nombre, lat, lon)) a la tienda más cercana.
+
+    Devuelve DataFrame [parroquia, lat, lon, distancia_km, tienda], ordenado de mayor a menor distancia.
+    """
+    nombres = [p[0] for p in parroquias]
+    coords = np.array([[p[1], p[2]] for p in parroquias], dtype=float).reshape(-1, 2)
+    if len(indice) == 0:
+        dist = np.full(len(nombres), np.inf)
+        tienda = np.full(len(nombres), -1, dtype=np.int64)
+    else:
+        _, i = indice.k_vecinos(coords, k=1)
+        tienda = i[:, 0]
+        # el índice elige la tienda; la distancia reportada es la haversine exacta
+        cercana = indice.coords[tienda]
+        dist = haversine_km_vec(coords[:, 0], coords[:, 1], cercana[:, 0], cercana[:, 1])
+    df = pd.DataFrame({
+        "parroquia": nombres,
+        "lat": coords[:, 0],
+        "lon": coords[:, 1],
+        "distancia_km": dist,
+        "tienda": tienda,
+    })
+    return df.sort_values("distancia_km", ascending=False).reset_index(drop=True)
+
+
+def parroquias_desatendidas(cobertura, umbral_km):
+    """Parroquias cuya tienda más cercana está a más de `umbral_km`."""
+    return cobertura[cobertura["distancia_km"] > umbral_km].reset_index(drop=True)
+
+
+def agrupar_tiendas(indice, radio_km):
+    """
+    Agrupa tiendas conectadas por cadenas de distancias <= `radio_km` (componentes conexas).
+
+    Devuelve un array de etiquetas de grupo (0..g-1) por tienda, numeradas por orden de aparición.
+    """
+    n = len(indice)
+    padre = np.arange(n)
+
+    def _raiz(i):
+        while padre[i] != i:
+            padre[i] = padre[padre[i]]
+            i = padre[i]
+        return i
+
+    for i, j in indice.pares_en_radio(radio_km):
+        ri, rj = _raiz(i), _raiz(j)
+        if ri != rj:
+            padre[max(ri, rj)] = min(ri, rj)
+
+    raices = np.array([_raiz(i) for i in range(n)], dtype=np.int64)
+    _, etiquetas = np.unique(raices, return_inverse=True)
+    return etiquetas.ravel()
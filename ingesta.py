@@ -0,0 +1,230 @@
+import io
+import os
+import multiprocessing
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+# ==============================
+# INGESTA DE ARCHIVOS (sin Streamlit: se ejecuta en procesos de trabajo)
+# ==============================
+
+def detectar_separador(uploaded_file):
+    """Detecta separador más probable en los primeros bytes."""
+    try:
+        head = uploaded_file.getvalue()[:8192]
+        s = head.decode('latin1', errors='ignore')
+        candidates = ['|', ';', ',', '\t']
+        counts = {sep: s.count(sep) for sep in candidates}
+        sep = max(counts, key=counts.get)
+        uploaded_file.seek(0)
+        return sep
+    except Exception:
+        try:
+            uploaded_file.seek(0)
+        except:
+            pass
+        return '|'
+
+
+def _sin_acentos(texto):
+    """Minúsculas y sin tildes, para comparar nombres ('MANABI' == 'Manabí')."""
+    s = unicodedata.normalize('NFKD', str(texto))
+    return ''.join(ch for ch in s if not unicodedata.combining(ch)).strip().lower()
+
+
+def detectar_provincia(uploaded_file, df, provincias, por_defecto=None):
+    """
+    Detecta provincia por nombre de archivo o, si no, por la moda de la columna provincia.
+
+    Devuelve el nombre canónico de `provincias` cuando coincide (sin distinguir
+    mayúsculas ni tildes); `por_defecto` si no se detecta.
+    """
+    canonicas = {_sin_acentos(prov): prov for prov in provincias}
+    try:
+        nombre = _sin_acentos(uploaded_file.name)
+        for clave, prov in canonicas.items():
+            if clave in nombre:
+                return prov
+    except:
+        pass
+    for col in df.columns:
+        if 'provincia' in col.lower():
+            val = df[col].dropna().mode()
+            if not val.empty:
+                valor = str(val.iloc[0]).strip()
+                # provincias fuera de la lista: al menos unificar el formato entre archivos
+                return canonicas.get(_sin_acentos(valor), valor.title())
+    return por_defecto
+
+
+def leer_csv(archivo):
+    """Lee el CSV detectando separador; devuelve (df, sep)."""
+    sep = detectar_separador(archivo)
+    archivo.seek(0)
+    df = pd.read_csv(archivo, sep=sep, encoding='latin1', engine='python', on_bad_lines='skip', dtype=str)
+
+    # Si quedó todo en una columna y hay muchos ';' en el contenido, reintentar con ';'
+    if df.shape[1] == 1:
+        col0 = df.columns[0]
+        sample = df[col0].dropna().head(5).astype(str)
+        if sample.str.contains(';').sum() >= 1:
+            archivo.seek(0)
+            df_try = pd.read_csv(archivo, sep=';', encoding='latin1', engine='python', on_bad_lines='skip', dtype=str)
+            if df_try.shape[1] > 1:
+                df = df_try
+                sep = ';'
+    return df, sep
+
+
+def normalizar_columnas(df):
+    """Nombres de columna en mayúsculas, sin espacios ni BOM (UTF-8 leído como latin1)."""
+    df = df.copy()
+    df.columns = [str(c).replace('\u00ef\u00bb\u00bf', '').replace('\ufeff', '').strip().upper() for c in df.columns]
+    return df
+
+
+def filtrar_por_ciiu(df, codigos, estricto=False):
+    """
+    Filtra por códigos CIIU de librerías y por contribuyentes activos.
+
+    Devuelve (filtrado, avisos): los avisos son textos para mostrar al usuario.
+    Sin `estricto`, si no hay columna CIIU o ningún código coincide se devuelven todos
+    los registros; con `estricto` esos casos lanzan ValueError.
+    """
+    avisos = []
+
+    col_ciiu = None
+    for c in df.columns:
+        if 'ciiu' in c.lower():
+            col_ciiu = c
+            break
+
+    if not col_ciiu:
+        if estricto:
+            raise ValueError("No se encontró columna CIIU.")
+        avisos.append("No se encontró columna CIIU. Se mostrarán todos los registros.")
+        return df.copy(), avisos
+
+    df_temp = df.copy()
+
+    # Limpiar valores CIIU
+    df_temp.loc[:, col_ciiu] = df_temp[col_ciiu].astype(str).str.strip()
+
+    # Filtrar por CIIU
+    mask = df_temp[col_ciiu].apply(lambda x: any(code in x for code in codigos))
+    filtrado = df_temp[mask].copy()
+
+    if filtrado.empty:
+        if estricto:
+            raise ValueError("No se encontraron registros con los códigos CIIU de librerías.")
+        avisos.append("No se encontraron registros con los códigos CIIU de librerías. Se mostrarán todos.")
+        return df_temp, avisos
+
+    # Filtrar solo ACTIVO si la columna existe
+    if "ESTADO_CONTRIBUYENTE" in filtrado.columns:
+        filtrado.loc[:, "ESTADO_CONTRIBUYENTE"] = (
+            filtrado["ESTADO_CONTRIBUYENTE"].astype(str).str.upper().str.strip()
+        )
+        filtrado = filtrado[filtrado["ESTADO_CONTRIBUYENTE"] == "ACTIVO"].copy()
+    else:
+        avisos.append("No se encontró la columna ESTADO_CONTRIBUYENTE. No se aplicó el filtro de activos.")
+
+    return filtrado, avisos
+
+
+def procesar_archivo(nombre, contenido, codigos, provincias, estricto=True):
+    """
+    Lee, detecta provincia y filtra por CIIU un archivo (bytes).
+
+    Con `estricto` (lotes de varios archivos), un archivo sin columna CIIU, sin códigos
+    de librerías o sin provincia detectable es un error, para no mezclar datos ajenos.
+    Sin `estricto` (un solo archivo) se mantiene el respaldo: todos los registros y Pichincha.
+
+    Nunca lanza excepción: los errores se devuelven en 'error' para no abortar el lote.
+    """
+    resultado = {'archivo': nombre, 'provincia': None, 'sep': None, 'registros': 0,
+                 'filtrado': None, 'avisos': [], 'error': None}
+    try:
+        archivo = io.BytesIO(contenido)
+        archivo.name = nombre
+        df, sep = leer_csv(archivo)
+        df = normalizar_columnas(df)
+        filtrado, avisos = filtrar_por_ciiu(df, codigos, estricto=estricto)
+        provincia = detectar_provincia(archivo, df, provincias)
+        if provincia is None:
+            if estricto:
+                raise ValueError("No se pudo detectar la provincia (ni por nombre de archivo ni por columna).")
+            provincia = "Pichincha"
+            avisos.append("No se pudo detectar la provincia; se usará Pichincha.")
+        resultado.update({
+            'provincia': provincia,
+            'sep': sep,
+            'registros': len(df),
+            'filtrado': filtrado,
+            'avisos': avisos,
+        })
+    except ValueError as e:
+        resultado['error'] = str(e)
+    except Exception as e:
+        resultado['error'] = f"{type(e).__name__}: {e}"
+    return resultado
+
+
+def procesar_archivos(archivos, codigos, provincias, max_workers=None, al_terminar=None):
+    """
+    Procesa en paralelo (pool de procesos) una lista de (nombre, bytes).
+
+    `al_terminar(resultado, hechos, total)` se llama en el proceso principal a medida
+    que termina cada archivo. Devuelve los resultados en el orden de entrada.
+    Con más de un archivo el procesamiento es estricto (ver `procesar_archivo`).
+    """
+    total = len(archivos)
+    resultados = [None] * total
+    if total == 0:
+        return resultados
+    max_workers = max_workers or min(total, os.cpu_count() or 1)
+    codigos = list(codigos)
+    provincias = list(provincias)
+    estricto = total > 1
+
+    # 'spawn': el proceso de Streamlit tiene hilos activos, no es seguro hacer fork
+    contexto = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=contexto) as pool:
+        futuros = {
+            pool.submit(procesar_archivo, nombre, contenido, codigos, provincias, estricto): i
+            for i, (nombre, contenido) in enumerate(archivos)
+        }
+        for hechos, futuro in enumerate(as_completed(futuros), start=1):
+            i = futuros[futuro]
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                # el proceso de trabajo murió (p. ej. memoria): solo falla este archivo
+                resultado = {'archivo': archivos[i][0], 'provincia': None, 'sep': None, 'registros': 0,
+                             'filtrado': None, 'avisos': [], 'error': f"{type(e).__name__}: {e}"}
+            resultados[i] = resultado
+            if al_terminar:
+                al_terminar(resultado, hechos, total)
+    return resultados
+
+
+def combinar_resultados(resultados):
+    """
+    Une los datos filtrados de los archivos sin error en un solo DataFrame normalizado,
+    con columnas ARCHIVO_ORIGEN y PROVINCIA_DETECTADA al final.
+    """
+    partes = []
+    for r in resultados:
+        if r is None or r['error'] is not None or r['filtrado'] is None:
+            continue
+        parte = r['filtrado'].copy()
+        parte['ARCHIVO_ORIGEN'] = r['archivo']
+        parte['PROVINCIA_DETECTADA'] = r['provincia']
+        partes.append(parte)
+    if not partes:
+        return pd.DataFrame(columns=['ARCHIVO_ORIGEN', 'PROVINCIA_DETECTADA'])
+    df = pd.concat(partes, ignore_index=True, sort=False)
+    columnas = [c for c in df.columns if c not in ('ARCHIVO_ORIGEN', 'PROVINCIA_DETECTADA')]
+    return df[columnas + ['ARCHIVO_ORIGEN', 'PROVINCIA_DETECTADA']]